@@ -2,17 +2,32 @@ import os
 import time
 import hashlib
 import json
+import threading
+import functools
+import ssl
+import base64
 from pathlib import Path
-import math
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 
-from typing import Iterator, List, Optional, Deque, TypeVar, Protocol, Union, Tuple
+from typing import Iterator, List, Optional, TypeVar, Protocol, Union, Tuple
 from abc import ABC, abstractmethod
 
-from urllib.request import Request, urlopen
+from urllib.request import Request, urlopen, getproxies, proxy_bypass
 from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, unquote
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
 
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:  # orjson is optional, and only makes JSON faster
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+    _loads = json.loads
 
+
+@functools.lru_cache(maxsize=4096)
 def prompt_id(prompt: str) -> str:
     return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
 
@@ -60,7 +75,11 @@ class ReplicationCacheMiss(Exception):
 
 
 class _BaseBufferedModel(Model):
-    """A base model with buffered queries abstracted via _query method"""
+    """A base model with buffered queries abstracted via _query method.
+
+    A batch larger than max_batch is split into sub-batches that are queried
+    concurrently, so _query must be thread-safe.
+    """
 
     def __init__(self,
                  model_name: str,
@@ -68,37 +87,202 @@ class _BaseBufferedModel(Model):
                  alias: Optional[str] = None,
                  max_batch: int = 1):
         super().__init__(model_name, temperature, alias, max_batch)
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._max_workers: Optional[int] = None  # executor default
+
+    def __getstate__(self):
+        # the lock and the executor cannot be pickled, they are recreated instead
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_executor"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._executor = None
 
     @abstractmethod
     def _query(self, prompt: str, n: int) -> List[str]:
         raise NotImplementedError()
 
+    def _submit(self, prompt: str, sizes: List[int]) -> List[Future]:
+        """Start querying sub-batches in the background"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._max_workers)
+        return [self._executor.submit(self._query, prompt, n) for n in sizes]
+
+    def _dispatch(self, prompt: str, sizes: List[int]) -> List[str]:
+        """Query sub-batches concurrently, and concatenate responses in order"""
+        if len(sizes) == 1:
+            return self._query(prompt, sizes[0])
+        return [r for f in self._submit(prompt, sizes) for r in f.result()]
+
     class _BufferedIterator(BatchedIterator):
 
-        def __init__(self, base, prompt):
+        def __init__(self, base, prompt, prefetch=False):
             self.base = base
             self.prompt = prompt
-            self._buffer: Deque[str] = deque()
+            self.prefetch = prefetch
+            self._buffer: List[str] = []
+            self._next = 0  # index of the first unconsumed response in _buffer
+            self._pending: Optional[List[Future]] = None
 
         def __iter__(self):
             return self
 
         def set_batch_size(self, n: int) -> None:
-            batches = max(1, math.ceil(n / self.base.max_batch))
-            self.batch_size = math.ceil(n / batches)            
+            self.batch_size = n
+            batches = max(1, -(-n // self.base.max_batch))
+            size = -(-n // batches)
+            self._batch_sizes = [size] * (batches - 1) + [n - size * (batches - 1)]
+            self._low_water = n // 2
 
         def __next__(self):
-            if len(self._buffer) == 0:
-                responses = self.base._query(self.prompt, self.batch_size)
-                self._buffer.extend(responses)            
-            return self._buffer.popleft()        
-
-    def sample(self, prompt: str, batch: int = 1) -> BatchedIterator[str]:
-        i = _BaseBufferedModel._BufferedIterator(self, prompt)
+            if self._next >= len(self._buffer):
+                if self._pending is not None:
+                    pending, self._pending = self._pending, None
+                    self._buffer = [r for f in pending for r in f.result()]
+                else:
+                    self._buffer = self.base._dispatch(self.prompt, self._batch_sizes)
+                self._next = 0
+            response = self._buffer[self._next]
+            self._next += 1
+            if self.prefetch and self._pending is None and len(self._buffer) - self._next <= self._low_water:
+                self._pending = self.base._submit(self.prompt, self._batch_sizes)
+            return response
+
+    def sample(self, prompt: str, batch: int = 1, prefetch: bool = False) -> BatchedIterator[str]:
+        """With prefetch=True, the next batch is queried in the background once
+        half of the current one is consumed. This hides query latency, but
+        the prefetched batch is paid for even if it is never consumed.
+        """
+        i = _BaseBufferedModel._BufferedIterator(self, prompt, prefetch)
         i.set_batch_size(batch)
         return i
 
 
+class _ConnectionPool:
+    """Keep-alive HTTP(S) connections to a single host, shared between threads.
+
+    Like urlopen, it honours the proxy environment variables (HTTP_PROXY,
+    HTTPS_PROXY, NO_PROXY); HTTPS requests are tunnelled through the proxy.
+    """
+
+    def __init__(self,
+                 base_url: str,
+                 maxsize: int = 10,
+                 block: bool = False,
+                 connect_timeout: Optional[float] = 10.0,
+                 read_timeout: Optional[float] = None):
+        url = urlsplit(base_url)
+        self._https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip("/")
+        self.maxsize = maxsize
+        self.block = block
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._proxy: Optional[Tuple[str, Optional[int]]] = None
+        self._proxy_headers: dict = {}
+        proxy = getproxies().get(url.scheme)
+        if proxy and not proxy_bypass(url.netloc):
+            if "://" not in proxy:
+                proxy = f"http://{proxy}"
+            proxy_url = urlsplit(proxy)
+            self._proxy = (proxy_url.hostname, proxy_url.port)
+            if proxy_url.username is not None:
+                credentials = f"{unquote(proxy_url.username)}:{unquote(proxy_url.password or '')}"
+                self._proxy_headers["Proxy-Authorization"] = \
+                    "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+            if not self._https:
+                # a proxy forwards plain HTTP requests by their absolute URL:
+                self.path = f"http://{url.netloc}{self.path}"
+        self._init_resources()
+
+    def _init_resources(self):
+        # creating a context loads CA certificates, so it is shared by all connections:
+        self._context = ssl.create_default_context() if self._https else None
+        self._idle: List[HTTPConnection] = []
+        self._lock = threading.Lock()
+        # when blocking, at most maxsize connections are in use at the same time:
+        self._slots = threading.BoundedSemaphore(self.maxsize) if self.block else None
+
+    def __getstate__(self):
+        # connections, locks and the TLS context cannot be pickled, they are recreated instead
+        state = self.__dict__.copy()
+        for name in ("_context", "_idle", "_lock", "_slots"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_resources()
+
+    def request(self, method: str, path: str, body: bytes, headers: dict) -> Tuple[int, str, bytes]:
+        """Send a request, and return status, reason and body of the response"""
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            conn, reused = self._get()
+            try:
+                try:
+                    response = self._send(conn, method, path, body, headers)
+                except (ConnectionError, HTTPException):
+                    if not reused:
+                        raise
+                    # the server may have dropped the idle connection, reconnect once:
+                    conn.close()
+                    response = self._send(conn, method, path, body, headers)
+            except BaseException:
+                conn.close()
+                raise
+            self._put(conn)
+            return response
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    def _send(self, conn: HTTPConnection, method: str, path: str, body: bytes, headers: dict) -> Tuple[int, str, bytes]:
+        if conn.sock is None:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+        if self._proxy is not None and not self._https:
+            headers = {**headers, **self._proxy_headers}
+        conn.request(method, self.path + path, body=body, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, resp.reason, resp.read()
+
+    def _get(self) -> Tuple[HTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        host, port = self._proxy if self._proxy is not None else (self.host, self.port)
+        if self._https:
+            conn = HTTPSConnection(host, port, timeout=self.connect_timeout, context=self._context)
+            if self._proxy is not None:
+                conn.set_tunnel(self.host, self.port, self._proxy_headers)
+        else:
+            conn = HTTPConnection(host, port, timeout=self.connect_timeout)
+        return conn, False
+
+    def _put(self, conn: HTTPConnection):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
 class OpenAICompatibleHTTPModel(_BaseBufferedModel):
     """
     Expected endpoint: POST {base_url}/chat/completions
@@ -121,6 +305,12 @@ class OpenAICompatibleHTTPModel(_BaseBufferedModel):
           ...
         ]
       }
+
+    Connections are kept alive and reused across queries. At most pool_maxsize
+    idle connections are retained; with pool_block=True, at most pool_maxsize
+    connections are open at the same time. A read_timeout of None waits for
+    the response indefinitely. Concurrent sub-batches are limited to
+    pool_maxsize, so that each of them reuses a pooled connection.
     """
 
     def __init__(
@@ -132,19 +322,42 @@ class OpenAICompatibleHTTPModel(_BaseBufferedModel):
         alias: Optional[str] = None,
         max_batch: int = 1,
         max_retries: int = 3,
-        retry_delay: float = 5.0
+        retry_delay: float = 5.0,
+        pool_maxsize: int = 10,
+        pool_block: bool = False,
+        connect_timeout: Optional[float] = 10.0,
+        read_timeout: Optional[float] = None
     ):
         super().__init__(model_name, temperature, alias, max_batch)
         self.base_url = base_url
         self.api_key = api_key
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self._pool = _ConnectionPool(base_url, pool_maxsize, pool_block, connect_timeout, read_timeout)
+        self._max_workers = pool_maxsize
         self._total_token_count = (0,0)
         self._total_query_time = 0.0
 
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        pool = getattr(self, "_pool", None)
+        if pool is not None:
+            pool.close()
+
     def _post_json(self, path: str, payload: dict) -> dict:
-        url = f"{self.base_url}{path}"
-        data = json.dumps(payload).encode("utf-8")
+        data = _dumps(payload)
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
@@ -153,20 +366,18 @@ class OpenAICompatibleHTTPModel(_BaseBufferedModel):
         }
         last_error = None
         for attempt in range(self.max_retries):
-            req = Request(url, data=data, headers=headers, method="POST")
             try:
-                with urlopen(req) as resp:
-                    raw = resp.read()
-                    return json.loads(raw.decode("utf-8"))
-            except HTTPError as e:
-                body = e.read().decode("utf-8", errors="ignore")
-                last_error = RuntimeError(f"HTTPError {e.code} {e.reason}: {body}")
-                last_error.__cause__ = e
-                if e.code < 500:
-                    raise last_error from e
-            except URLError as e:
-                last_error = RuntimeError(f"URLError: {e.reason}")
+                status, reason, raw = self._pool.request("POST", path, data, headers)
+            except (OSError, HTTPException) as e:
+                last_error = RuntimeError(f"{type(e).__name__}: {e}")
                 last_error.__cause__ = e
+            else:
+                if status < 300:
+                    return _loads(raw)
+                body = raw.decode("utf-8", errors="ignore")
+                last_error = RuntimeError(f"HTTPError {status} {reason}: {body}")
+                if status < 500:
+                    raise last_error
             if attempt < self.max_retries - 1:
                 time.sleep(self.retry_delay)
         raise last_error
@@ -180,10 +391,11 @@ class OpenAICompatibleHTTPModel(_BaseBufferedModel):
         }
         start = time.perf_counter()
         resp = self._post_json("/chat/completions", payload)
-        self._total_query_time += time.perf_counter() - start
-        current_prompt_tokens, current_completion_tokens = self._total_token_count
-        self._total_token_count = (resp["usage"]["prompt_tokens"] + current_prompt_tokens,
-                                   resp["usage"]["completion_tokens"] + current_completion_tokens)
+        with self._lock:
+            self._total_query_time += time.perf_counter() - start
+            current_prompt_tokens, current_completion_tokens = self._total_token_count
+            self._total_token_count = (resp["usage"]["prompt_tokens"] + current_prompt_tokens,
+                                       resp["usage"]["completion_tokens"] + current_completion_tokens)
         return [str(c["message"]["content"]) for c in resp["choices"]]
 
     def total_query_time(self) -> float:
@@ -227,7 +439,7 @@ class Ollama(_BaseBufferedModel):
 
     def _post_json_stream(self, path: str, payload: dict):
         url = f"{self.base_url}{path}"
-        data = json.dumps(payload).encode("utf-8")
+        data = _dumps(payload)
         headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -272,7 +484,7 @@ class Ollama(_BaseBufferedModel):
                     line = raw_line.decode("utf-8", errors="ignore").strip()
                     if not line:
                         continue
-                    obj = json.loads(line)
+                    obj = _loads(line)
 
                     msg = obj.get("message") or {}
                     parts.append(msg.get("content", ""))
@@ -284,9 +496,10 @@ class Ollama(_BaseBufferedModel):
             finally:
                 resp.close()
 
-            self._total_query_time += time.perf_counter() - start
-            cur_p, cur_c = self._total_token_count
-            self._total_token_count = (cur_p + prompt_tokens, cur_c + completion_tokens)
+            with self._lock:
+                self._total_query_time += time.perf_counter() - start
+                cur_p, cur_c = self._total_token_count
+                self._total_token_count = (cur_p + prompt_tokens, cur_c + completion_tokens)
 
             out.append("".join(parts))
 
@@ -300,31 +513,31 @@ class Ollama(_BaseBufferedModel):
 
 
 class FireworksAI(OpenAICompatibleHTTPModel):
-    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0):
+    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0, pool_maxsize: int = 10, pool_block: bool = False, connect_timeout: Optional[float] = 10.0, read_timeout: Optional[float] = None):
         base_url = "https://api.fireworks.ai/inference/v1"
         api_key = os.environ["FIREWORKS_API_KEY"]
-        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay)
+        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay, pool_maxsize, pool_block, connect_timeout, read_timeout)
 
 
 class AI302(OpenAICompatibleHTTPModel):
-    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0):
+    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0, pool_maxsize: int = 10, pool_block: bool = False, connect_timeout: Optional[float] = 10.0, read_timeout: Optional[float] = None):
         base_url = "https://api.302.ai/v1"
         api_key = os.environ["AI302_API_KEY"]
-        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay)
+        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay, pool_maxsize, pool_block, connect_timeout, read_timeout)
 
 
 class CloseAI(OpenAICompatibleHTTPModel):
-    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0):
+    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0, pool_maxsize: int = 10, pool_block: bool = False, connect_timeout: Optional[float] = 10.0, read_timeout: Optional[float] = None):
         base_url = "https://api.openai-proxy.org/v1"
         api_key = os.environ["CLOSEAI_API_KEY"]
-        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay)
+        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay, pool_maxsize, pool_block, connect_timeout, read_timeout)
 
 
 class XMCP(OpenAICompatibleHTTPModel):
-    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0):
+    def __init__(self, model_name: str, temperature: float, alias: Optional[str] = None, max_batch: int = 1, max_retries: int = 3, retry_delay: float = 5.0, pool_maxsize: int = 10, pool_block: bool = False, connect_timeout: Optional[float] = 10.0, read_timeout: Optional[float] = None):
         base_url = "https://llm.xmcp.ltd"
         api_key = os.environ["XMCP_API_KEY"]
-        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay)
+        super().__init__(base_url, api_key, model_name, temperature, alias, max_batch, max_retries, retry_delay, pool_maxsize, pool_block, connect_timeout, read_timeout)
 
 
 class Independent(Model):
@@ -336,17 +549,16 @@ class Independent(Model):
                          inner.alias,
                          inner.max_batch)
         self._inner = inner
-        self._inner_iters = {}  # prompt_hash -> sample sequence
+        self._inner_iters = {}  # prompt -> sample sequence
 
     def sample(self, prompt: str, batch: int = 1) -> BatchedIterator[str]:
         if isinstance(self._inner, Independent):
             return self._inner.sample(prompt, batch)
         # for the same prompt, always return the same iterator
-        pid = prompt_id(prompt)
-        if pid not in self._inner_iters:
-            self._inner_iters[pid] = self._inner.sample(prompt, batch)
-        self._inner_iters[pid].set_batch_size(batch)
-        return self._inner_iters[pid]
+        if prompt not in self._inner_iters:
+            self._inner_iters[prompt] = self._inner.sample(prompt, batch)
+        self._inner_iters[prompt].set_batch_size(batch)
+        return self._inner_iters[prompt]
 
     def total_query_time(self) -> float:
         return self._inner.total_query_time()
@@ -365,6 +577,9 @@ class _BaseBatchedCache(Model):
     @abstractmethod
     def _load(self, pid: str) -> list[str]:
         raise NotImplementedError()
+
+    def _prompt_key(self, prompt: str) -> str:
+        return prompt_id(prompt)
     
     def __init__(self, inner: Model, fail_on_miss: bool = False):
         super().__init__(inner.model_name,
@@ -372,16 +587,20 @@ class _BaseBatchedCache(Model):
                          inner.alias,
                          inner.max_batch)
         # the cache calls the inner model only when it needs a fresh sample:
-        self._inner = Independent(inner)
+        if isinstance(inner, Independent):
+            self._inner = inner
+        else:
+            self._inner = Independent(inner)
         self.fail_on_miss = fail_on_miss
 
     class _SharedCacheIterator(BatchedIterator[str]):
         def __init__(self, base, prompt: str):
             self.base = base
             self.prompt = prompt
-            self.pid = prompt_id(prompt)
+            self.pid = base._prompt_key(prompt)
             self.batch_size = 1
             self.current_index = 0
+            self._inner_iter: Optional[BatchedIterator[str]] = None
 
         def set_batch_size(self, n: int) -> None:
             self.batch_size = n
@@ -396,10 +615,17 @@ class _BaseBatchedCache(Model):
                 return cache[self.current_index - 1]
             if self.base.fail_on_miss:
                 raise ReplicationCacheMiss()
-            fresh = next(self.base._inner.sample(self.prompt, self.batch_size))
+            if self._inner_iter is None:
+                self._inner_iter = self.base._inner.sample(self.prompt, self.batch_size)
+            else:
+                # the inner iterator is shared per prompt, other callers may have resized it
+                self._inner_iter.set_batch_size(self.batch_size)
+            fresh = next(self._inner_iter)
             self.base._store(self.pid, fresh)
+            # if others stored responses concurrently, return them in the order they are stored
+            cache = self.base._load(self.pid)
             self.current_index += 1
-            return fresh
+            return cache[self.current_index - 1]
 
     def sample(self, prompt: str, batch: int = 1) -> BatchedIterator[str]:
         i = _BaseBatchedCache._SharedCacheIterator(self, prompt)
@@ -412,7 +638,11 @@ class Repeatable(_BaseBatchedCache):
 
     def __init__(self, inner: Model):
         super().__init__(inner)
-        self._cache = dict() # prompt_id -> list of responses
+        self._cache = dict() # prompt -> list of responses
+
+    def _prompt_key(self, prompt: str) -> str:
+        # in memory, the prompt itself is a cheaper key than its hash
+        return prompt
 
     def _store(self, pid: str, response: str):
         if pid not in self._cache:
@@ -443,6 +673,10 @@ class Persistent(_BaseBatchedCache):
           0.md
           1.md
           ...
+
+    Responses for a prompt are read from disk once, and then served from memory.
+    If another instance or process stored responses in the meantime, they are
+    re-read when storing a new response, which takes the next free number.
     """
     def __init__(self, inner: Model, cache_root: Union[Path, str], replication: bool = False):
         super().__init__(inner, replication)
@@ -451,29 +685,96 @@ class Persistent(_BaseBatchedCache):
         cache_root = cache_root.expanduser()
         self.cache_root = cache_root
         self.replication = replication
+        t = f"{self.temperature:.3f}".rstrip("0").rstrip(".")
+        self._model_key = f"{self.alias}_{t}"
+        self._index: dict[str, list[str]] = dict() # prompt_id -> list of responses
+        self._counts: dict[str, int] = dict() # prompt_id -> next response number, re-synced on clashes
 
     def _store(self, pid: str, response: str):
         d = self._prompt_dir(pid)
-        d.mkdir(parents=True, exist_ok=True)
-        i = len(Persistent._list_numbered_files(d))
-        f = d / f"{i}.md"
-        f.write_text(response)
- 
+        i = self._counts.get(pid)
+        if i is None:
+            d.mkdir(parents=True, exist_ok=True)
+            if pid in self._index:
+                i = len(self._index[pid])
+            else:
+                i = len(Persistent._list_numbered_files(d))
+        # write to a temporary file first, so that a crash never leaves a partial response:
+        data = response.encode("utf-8")
+        tmp = d / f".{os.getpid()}_{threading.get_ident()}.tmp"
+        Persistent._write_file(tmp, data)
+        try:
+            while True:
+                try:
+                    Persistent._publish(tmp, d / f"{i}.md", data)
+                    break
+                except FileExistsError:
+                    # another instance or process stored a response first
+                    i = self._resync(pid)
+        finally:
+            os.unlink(tmp)
+        self._counts[pid] = i + 1
+        if pid in self._index:
+            self._index[pid].append(response)
+
+    def _resync(self, pid: str) -> int:
+        """Re-read stored responses from disk, and return their number"""
+        files = Persistent._list_numbered_files(self._prompt_dir(pid))
+        if pid in self._index:
+            self._index[pid] = [Persistent._read_file(f) for f in files]
+        self._counts[pid] = len(files)
+        return len(files)
+
     def _load(self, pid: str) -> list[str]:
-        d = self._prompt_dir(pid)
-        return [f.read_text() for f in Persistent._list_numbered_files(d)]
+        if pid not in self._index:
+            d = self._prompt_dir(pid)
+            self._index[pid] = [Persistent._read_file(f) for f in Persistent._list_numbered_files(d)]
+        return self._index[pid]
 
-    def _prompt_dir(self, pid: str) -> str:
-        t = f"{self.temperature:.3f}".rstrip("0").rstrip(".")
-        model_key = f"{self.alias}_{t}"
-        return self.cache_root / model_key / pid
+    @staticmethod
+    def _read_file(path: str) -> str:
+        with open(path, "rb", buffering=0) as f:
+            text = f.read().decode("utf-8")
+        # universal newlines, as in text mode (e.g. responses written on Windows)
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    @staticmethod
+    def _publish(tmp: Path, path: Path, data: bytes):
+        """Create path with the content of tmp; raise FileExistsError if it exists"""
+        try:
+            # unlike a rename, a link never overwrites an existing response
+            os.link(tmp, path)
+        except FileExistsError:
+            raise
+        except OSError:
+            # no hard links on this filesystem (e.g. FAT, some SMB and FUSE mounts),
+            # so create the file exclusively and write it in place:
+            Persistent._write_file(path, data, exclusive=True)
+
+    @staticmethod
+    def _write_file(path: Path, data: bytes, exclusive: bool = False):
+        # unbuffered, to avoid setting up a file object for a single write:
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+        fd = os.open(path, flags, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def _prompt_dir(self, pid: str) -> Path:
+        return self.cache_root / self._model_key / pid
 
     @staticmethod
     def _list_numbered_files(path: Path) -> List[str]:
-        if not path.is_dir():
+        try:
+            with os.scandir(path) as it:
+                entries = [e for e in it if e.name.endswith(".md")]
+        except (FileNotFoundError, NotADirectoryError):
             return []
-        md_files = list(path.glob('*.md'))
-        return sorted(md_files, key=lambda f: int(f.stem))
+        entries.sort(key=lambda e: int(e.name[:-3]))
+        return [e.path for e in entries]
 
     def total_query_time(self) -> float:
         return self._inner.total_query_time()
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from typing import Union, Any, Optional, List, Dict, Callable
+from functools import lru_cache
+from typing import Union, Any, Optional, List, Dict, Callable, Tuple
 
 from cached_llm import Model, Independent
 
@@ -17,29 +18,76 @@ class Match:
 
 @dataclass(frozen=True)
 class Sequence:
-    parts: List["OutputSpec"]
+    parts: Tuple["OutputSpec", ...]
+
+    def __post_init__(self):
+        # accept any iterable of parts, but store a tuple to keep the spec hashable
+        object.__setattr__(self, "parts", tuple(self.parts))
 
     def _match(self, text: str, pos: int) -> Match:
+        compiled = _compiled_matcher(self)
+        if compiled is not None:
+            return compiled(text, pos)
+        return self._match_parts(text, pos)
+
+    def _match_parts(self, text: str, pos: int) -> Match:
         cur = pos
         values: List[Any] = []
-        spans: List[tuple[int, int]] = []
+        start: Optional[int] = None
 
-        for i, part in enumerate(self.parts):
+        for part in self.parts:
             m = part._match(text, cur)
             values.append(m.value)
-            spans.append((m.start, m.end))
+            if start is None:
+                start = m.start
             cur = m.end
 
-        start = spans[0][0] if spans else pos
-        end = spans[-1][1] if spans else pos
-        return Match(start, end, values)
+        if start is None:
+            start = pos
+        return Match(start, cur, values)
     
 
+@lru_cache(maxsize=256)
+def _compiled_matcher(spec: Sequence) -> Optional[Callable[[str, int], Match]]:
+    """A straight-line matcher equivalent to _match_parts, generated for sequences of tags and code blocks.
+
+    It is cached by spec rather than stored on it, so that specs stay picklable and equal specs share it.
+    """
+    if not spec.parts or not all(isinstance(part, (Tag, Code)) for part in spec.parts):
+        return None
+    namespace: Dict[str, Any] = {"Match": Match, "LLMOutputError": LLMOutputError}
+    lines = ["def _match(text, cur):"]
+    for i, part in enumerate(spec.parts):
+        lines.extend(f"    {line}" for line in part._source(i, namespace))
+    values = ", ".join(f"v{i}" for i in range(len(spec.parts)))
+    lines.append(f"    return Match(s0, cur, [{values}])")
+    exec("\n".join(lines), namespace)
+    return namespace["_match"]
+
+
 @dataclass(frozen=True)
 class Tag:
     """HTML-style tag"""
     name: str
 
+    def _source(self, i: int, namespace: Dict[str, Any]) -> List[str]:
+        """Code of _match for the i-th part of a sequence, tokens are passed via namespace"""
+        open_tok = f"<{self.name}>"
+        close_tok = f"</{self.name}>"
+        namespace[f"open{i}"] = open_tok
+        namespace[f"close{i}"] = close_tok
+        return [
+            f"s{i} = text.find(open{i}, cur)",
+            f"if s{i} == -1:",
+            f"    raise LLMOutputError(f'Expected opening tag {{open{i}}} at {{cur}}')",
+            f"content_start = s{i} + {len(open_tok)}",
+            f"close_pos = text.find(close{i}, content_start)",
+            "if close_pos == -1:",
+            f"    raise LLMOutputError(f'Expected closing tag {{close{i}}} at {{content_start}}')",
+            f"v{i} = text[content_start:close_pos]",
+            f"cur = close_pos + {len(close_tok)}",
+        ]
+
     def _match(self, text: str, pos: int) -> Match:
         open_tok = f"<{self.name}>"
         close_tok = f"</{self.name}>"
@@ -61,6 +109,28 @@ class Tag:
 class Code:
     """Markdown code block"""
 
+    def _source(self, i: int, namespace: Dict[str, Any]) -> List[str]:
+        """Code of _match for the i-th part of a sequence"""
+        return [
+            f"s{i} = text.find('```', cur)",
+            f"if s{i} == -1:",
+            f"    raise LLMOutputError(f'Expected markdown code fence ``` at {{cur}}')",
+            f"after_open = s{i} + 3",
+            "nl = text.find('\\n', after_open)",
+            "if nl == -1:",
+            f"    raise LLMOutputError(f'Unterminated code block (no newline after opening fence) at {{after_open}}')",
+            "code_start = nl + 1",
+            "end_fence = text.find('\\n```', code_start)",
+            "if end_fence == -1:",
+            "    end_fence = text.find('```', code_start)",
+            "    if end_fence == -1:",
+            f"        raise LLMOutputError(f'Unterminated code block (missing closing fence ```) at {{code_start}}')",
+            "    cur = end_fence + 3",
+            "else:",
+            "    cur = end_fence + 4",
+            f"v{i} = text[code_start:end_fence]",
+        ]
+
     def _match(self, text: str, pos: int) -> Match:
         fence = "```"
         start = text.find(fence, pos)
@@ -85,7 +155,6 @@ class Code:
             code_end = end_fence
             end = end_fence + 1 + len(fence)
 
-        header = text[after_open:nl]  # language/info string (possibly empty)
         code = text[code_start:code_end]
         return Match(start, end, code)
 
@@ -132,7 +201,8 @@ def parse(spec: OutputSpec, text: str) -> Any:
 
 def query_retry(model: Model, prompt: str, spec: OutputSpec, retries: int = 1,
                 validator: Optional[Callable[[Any], bool]] = None) -> Any:
-    model = Independent(model)
+    if not isinstance(model, Independent):
+        model = Independent(model)
 
     for attempt in range(1, retries + 1):
         raw: Optional[str] = None
@@ -1,10 +1,22 @@
+import errno
+import json
+import os
+import pickle
+import threading
 from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
 from cached_llm import (
     prompt_id,
     Repeatable,
     Independent,
     Persistent,
     _BaseBufferedModel,
+    OpenAICompatibleHTTPModel,
+    AI302,
+    _ConnectionPool,
     Model,
     BatchedIterator
 )
@@ -59,6 +71,67 @@ def test_persistent(tmp_path):
     assert m.num_iterated == 3
 
 
+def test_persistent_store_without_load(tmp_path):
+    m = MockModel({ "prompt": [ "0", "1" ] })
+    c = Persistent(m, tmp_path)
+    pid = prompt_id("prompt")
+    c._store(pid, "0")
+    c._store(pid, "1")
+    assert Persistent(m, tmp_path)._load(pid) == [ "0", "1" ]
+    assert c._load(pid) == [ "0", "1" ]
+
+
+def test_persistent_without_hard_links(tmp_path, monkeypatch):
+    def link(src, dst):
+        raise OSError(errno.EPERM, "Operation not permitted")
+    monkeypatch.setattr(os, "link", link)
+    a = Persistent(MockModel({}), tmp_path)
+    b = Persistent(MockModel({}), tmp_path)
+    pid = prompt_id("prompt")
+    a._store(pid, "a0")
+    b._store(pid, "b0")
+    a._store(pid, "a1")
+    assert Persistent(MockModel({}), tmp_path)._load(pid) == [ "a0", "b0", "a1" ]
+    assert sorted(p.name for p in a._prompt_dir(pid).iterdir()) == [ "0.md", "1.md", "2.md" ]
+
+
+def test_persistent_universal_newlines(tmp_path):
+    c = Persistent(MockModel({}), tmp_path)
+    pid = prompt_id("prompt")
+    d = c._prompt_dir(pid)
+    d.mkdir(parents=True)
+    (d / "0.md").write_bytes(b"line1\r\nline2\rline3\n")
+    assert c._load(pid) == [ "line1\nline2\nline3\n" ]
+
+
+def test_persistent_shared_root_store_without_load(tmp_path):
+    a = Persistent(MockModel({}), tmp_path)
+    b = Persistent(MockModel({}), tmp_path)
+    pid = prompt_id("prompt")
+    a._store(pid, "a0")
+    b._store(pid, "b0")
+    a._store(pid, "a1")  # a's counter says 1, but 1.md is b's
+    b._store(pid, "b1")
+    assert Persistent(MockModel({}), tmp_path)._load(pid) == [ "a0", "b0", "a1", "b1" ]
+
+
+def test_persistent_shared_root(tmp_path):
+    a = Persistent(MockModel({ "prompt": [ "a0", "a1" ] }), tmp_path)
+    b = Persistent(MockModel({ "prompt": [ "b0", "b1" ] }), tmp_path)
+    sa = a.sample("prompt")
+    sb = b.sample("prompt")
+    assert next(sa) == "a0"
+    assert next(sb) == "a0"
+    assert next(sb) == "b0"
+    # a has not seen b0 yet, so its store clashes with b's and is renumbered:
+    assert next(sa) == "b0"
+    assert next(sa) == "a1"
+    assert a._load(prompt_id("prompt")) == [ "a0", "b0", "a1" ]
+    fresh = Persistent(MockModel({}), tmp_path)
+    assert fresh._load(prompt_id("prompt")) == [ "a0", "b0", "a1" ]
+    assert sorted(p.name for p in tmp_path.glob("*/*/*")) == [ "0.md", "1.md", "2.md" ]
+
+
 def test_repeatable():
     m = MockModel({ "prompt": [ "0", "1", "2", "3", "4" ] })
     c = Repeatable(m)
@@ -129,12 +202,14 @@ class MockBufferedModel(_BaseBufferedModel):
         for prompt in responses:
             self.current_indexes[prompt] = 0
         self.num_queries = 0
+        self.lock = threading.Lock()
 
     def _query(self, prompt: str, n: int):
-        self.num_queries += 1
-        index = self.current_indexes[prompt]
-        responses = self.responses[prompt][index:index + n]
-        self.current_indexes[prompt] = index + n
+        with self.lock:
+            self.num_queries += 1
+            index = self.current_indexes[prompt]
+            responses = self.responses[prompt][index:index + n]
+            self.current_indexes[prompt] = index + n
         return responses
 
     def total_query_time(self):
@@ -156,9 +231,37 @@ def test_batched():
 def test_batched_limit():
     m = MockBufferedModel({ "prompt": [ "0", "1", "2", "3", "4", "5" ] }, max_batch=2)
     responses = []
-    for r in islice(m.sample("prompt", batch=3), 6):
+    s = m.sample("prompt", batch=3)
+    assert s.batch_size == 3
+    for r in islice(s, 6):
         responses.append(r)
-    assert responses == [ "0", "1", "2", "3", "4", "5" ]
+    # sub-batches of 2 and 1 are queried concurrently, so their order may vary:
+    assert sorted(responses[:3]) == [ "0", "1", "2" ]
+    assert sorted(responses[3:]) == [ "3", "4", "5" ]
+    assert m.num_queries == 4
+
+
+def test_batched_concurrent():
+    m = MockBufferedModel({ "prompt": [ "0", "1", "2", "3" ] }, max_batch=2)
+    barrier = threading.Barrier(2, timeout=5)
+    query = m._query
+    def concurrent_query(prompt, n):
+        barrier.wait()  # fails unless both sub-batches are in flight
+        return query(prompt, n)
+    m._query = concurrent_query
+    assert sorted(islice(m.sample("prompt", batch=4), 4)) == [ "0", "1", "2", "3" ]
+    assert m.num_queries == 2
+
+def test_batched_prefetch():
+    m = MockBufferedModel({ "prompt": [ "0", "1", "2", "3", "4", "5" ] }, max_batch=2)
+    s = m.sample("prompt", batch=2, prefetch=True)
+    assert next(s) == "0"
+    for f in s._pending:
+        f.result()
+    assert m.num_queries == 2
+    assert list(islice(s, 3)) == [ "1", "2", "3" ]
+    for f in s._pending:
+        f.result()
     assert m.num_queries == 3
 
 def test_batched_cached():
@@ -172,3 +275,109 @@ def test_batched_cached():
         responses.append(s)
     assert responses == ["0", "1", "2", "3"]
     assert m.num_queries - start == 1
+
+
+def test_batched_persistent(tmp_path):
+    m = MockBufferedModel({ "prompt": [ "0", "1", "2", "3", "4" ] }, max_batch=2)
+    c = Persistent(m, tmp_path)
+    assert list(islice(c.sample("prompt", batch=2), 3)) == ["0", "1", "2"]
+    assert next(c.sample("prompt", batch=2)) == "0"
+    assert list(islice(c.sample("prompt", batch=2), 4)) == ["0", "1", "2", "3"]
+    assert m.num_queries == 2
+
+
+@pytest.fixture
+def chat_server(monkeypatch):
+    """A local chat completions endpoint that records client ports, paths and headers of requests"""
+    for name in ("http_proxy", "HTTP_PROXY", "https_proxy", "HTTPS_PROXY", "no_proxy", "NO_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+    ports = []
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            ports.append(self.client_address[1])
+            requests.append((self.path, dict(self.headers)))
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            body = json.dumps({
+                "choices": [{"message": {"content": str(i)}} for i in range(payload["n"])],
+                "usage": {"prompt_tokens": 1, "completion_tokens": payload["n"]}
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/v1", ports, requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_keep_alive(chat_server):
+    url, ports, _ = chat_server
+    with OpenAICompatibleHTTPModel(url, "key", "mock", 1.0, max_batch=2) as m:
+        responses = list(islice(m.sample("prompt", batch=2), 4))
+        assert responses == ["0", "1", "0", "1"]
+        assert m.total_token_count() == (2, 4)
+    assert len(ports) == 2
+    assert len(set(ports)) == 1
+
+
+def test_http_concurrent_keep_alive(chat_server):
+    url, ports, _ = chat_server
+    with OpenAICompatibleHTTPModel(url, "key", "mock", 1.0, max_batch=1, pool_maxsize=2) as m:
+        responses = list(islice(m.sample("prompt", batch=4), 8))
+        assert responses == ["0"] * 8
+    assert len(ports) == 8
+    assert len(set(ports)) <= 2
+
+
+def test_http_pickle(chat_server, tmp_path):
+    url, _, _ = chat_server
+    m = OpenAICompatibleHTTPModel(url, "key", "mock", 1.0, max_batch=1, pool_block=True)
+    assert list(islice(m.sample("prompt", batch=2), 2)) == ["0", "0"]
+    c = pickle.loads(pickle.dumps(Persistent(m, tmp_path)))
+    assert list(islice(c.sample("prompt", batch=2), 2)) == ["0", "0"]
+    assert c.total_token_count() == (4, 4)
+    m.close()
+    c._inner._inner.close()
+
+
+def test_provider_pool_options(monkeypatch):
+    monkeypatch.setenv("AI302_API_KEY", "key")
+    m = AI302("gpt-4o", 1.0, pool_maxsize=3, pool_block=True, connect_timeout=1.0, read_timeout=2.0)
+    assert (m._pool.maxsize, m._pool.block) == (3, True)
+    assert (m._pool.connect_timeout, m._pool.read_timeout) == (1.0, 2.0)
+    assert m._max_workers == 3
+
+
+def test_http_proxy(chat_server, monkeypatch):
+    proxy, _, requests = chat_server
+    # the chat server stands in for a forwarding proxy, and answers requests itself
+    monkeypatch.setenv("http_proxy", proxy.replace("http://", "http://user:pass@").removesuffix("/v1"))
+    with OpenAICompatibleHTTPModel("http://llm.example/v1", "key", "mock", 1.0) as m:
+        assert next(m.sample("prompt")) == "0"
+    path, headers = requests[0]
+    assert path == "http://llm.example/v1/chat/completions"
+    assert headers["Host"] == "llm.example"
+    assert headers["Proxy-Authorization"] == "Basic dXNlcjpwYXNz"
+
+
+def test_https_proxy_tunnel(monkeypatch):
+    monkeypatch.setenv("https_proxy", "http://127.0.0.1:3128")
+    monkeypatch.delenv("HTTPS_PROXY", raising=False)
+    monkeypatch.setenv("no_proxy", "bypass.example")
+    monkeypatch.delenv("NO_PROXY", raising=False)
+    conn, _ = _ConnectionPool("https://llm.example/v1")._get()
+    assert (conn.host, conn.port) == ("127.0.0.1", 3128)
+    assert conn._tunnel_host == "llm.example"
+    conn, _ = _ConnectionPool("https://bypass.example/v1")._get()
+    assert conn.host == "bypass.example"
@@ -1,5 +1,11 @@
+import pickle
+import re
+
+import pytest
+
 from structured_output import (
     Sequence, Tag, Code, Repeat,
+    LLMOutputError,
     parse
 )
 
@@ -31,3 +37,77 @@ tail text
     assert result[0] == "reasoning..."
     assert result[1] == "answer"
     assert result[2] == 'print("hi")\ntail text'
+
+
+def test_repeat():
+    spec = Sequence([
+        Tag("problem"),
+        Repeat(
+            Sequence([
+                Tag("algorithm"),
+                Code()
+            ]))])
+
+    out = """<problem>sum a list</problem>
+
+<algorithm>loop</algorithm>
+```python
+total = 0
+```
+
+<algorithm>builtin</algorithm>
+```
+total = sum(xs)
+```
+"""
+    result = parse(spec, out)
+
+    assert result == ["sum a list", [["loop", "total = 0"], ["builtin", "total = sum(xs)"]]]
+
+
+def test_repeat_empty():
+    assert parse(Repeat(Tag("a")), "no tags") == []
+    assert parse(Sequence([Repeat(Tag("a")), Tag("b")]), "<a>1</a><a>2</a><b>3</b>") == [["1", "2"], "3"]
+
+
+def test_hashable():
+    spec = Sequence([Tag("a"), Repeat(Sequence([Tag("b"), Code()]))])
+    same = Sequence((Tag("a"), Repeat(Sequence((Tag("b"), Code())))))
+    assert spec == same
+    assert hash(spec) == hash(same)
+
+
+def test_pickle_after_parse():
+    spec = Sequence([Tag("a"), Code()])
+    out = "<a>1</a>```\ncode\n```"
+    assert parse(spec, out) == ["1", "code"]
+    copy = pickle.loads(pickle.dumps(spec))
+    assert copy == spec
+    assert parse(copy, out) == ["1", "code"]
+
+
+@pytest.mark.parametrize("out", [
+    "<a>1</a><b>2</b>```\ncode\n```",
+    "<a>1</a><a>2</a><b>3</b> <b>4</b> ```py\nx```y\n```",
+    "<b>0</b><a>1<b>2</a>x<b>3</b>```\n```",
+    "<a></a><b></b>```\ncode```",
+])
+def test_compiled_sequence(out):
+    spec = Sequence([Tag("a"), Tag("b"), Code()])
+    expected = spec._match_parts(out, 0)
+    assert spec._match(out, 0) == expected
+    assert parse(spec, out) == expected.value
+
+
+@pytest.mark.parametrize("out", [
+    "<b>0</b><a>1</a>",
+    "<a>1<b>2</b>",
+    "<a>1</a><b>2</b>```",
+    "<a>1</a><b>2</b>```\ncode",
+])
+def test_compiled_sequence_error(out):
+    spec = Sequence([Tag("a"), Tag("b"), Code()])
+    with pytest.raises(LLMOutputError) as expected:
+        spec._match_parts(out, 0)
+    with pytest.raises(LLMOutputError, match=re.escape(str(expected.value))):
+        parse(spec, out)